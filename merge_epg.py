@@ -1,42 +1,92 @@
 import os
+import sys
+import multiprocessing
 import gzip
+try:
+    # ISA-L's SIMD inflate is a drop-in, much faster replacement for zlib when
+    # reading feeds; output stays on zlib, whose levels compress far tighter
+    from isal import igzip as feed_gzip
+except ImportError:
+    feed_gzip = gzip
+import json
+import hashlib
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree as ET
 import re
-from datetime import datetime, timedelta
-from io import BytesIO
-import pytz
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+from io import BufferedReader, BufferedWriter, BytesIO
+from zoneinfo import ZoneInfo
 from difflib import SequenceMatcher
+from functools import lru_cache
+from html import escape
 
 MASTER_LIST_FILE = "master_channels.txt"
 EPG_SOURCES_FILE = "epg_sources.txt"
 OUTPUT_XML_GZ = "merged.xml.gz"
+OUTPUT_HASH_FILE = OUTPUT_XML_GZ + ".sha256"
 INDEX_HTML = "index.html"
+FEED_CACHE_DIR = ".epg_cache"
 
 LOCAL_FEED_URL = "https://epgshare01.online/epgshare01/epg_ripper_US_LOCALS1.xml.gz"
 
+EASTERN_TZ = ZoneInfo("America/New_York")
+GZIP_MAGIC = b"\x1f\x8b"
+FETCH_AHEAD = 4
+FETCH_TIMEOUT = (10, 60)   # (connect, read) seconds
+READ_BUFFER_SIZE = 128 * 1024
+WRITE_BUFFER_SIZE = 1 << 20
+OUTPUT_COMPRESSLEVEL = 6
+OUTPUT_FORMAT_VERSION = 1   # bump when the XML serialization changes
+
 # -----------------------------
 # NORMALIZATION
 # -----------------------------
 remove_words = ["hd", "hdtv", "tv", "channel", "network", "east", "west", "us", "us2"]
+punctuation_map = str.maketrans({"×": "x", "/": " ", "(": " ", ")": " ", "&": " and ", "-": " "})
 regex_remove = re.compile(r"[^\w\s]")
+regex_remove_words = re.compile(r"\b(?:" + "|".join(remove_words) + r")\b")
 
+# Feeds repeat the same ids/display names heavily, so memoize the regex work
+@lru_cache(maxsize=131072)
 def clean_text(name):
     if not name:
         return ""
-    name = name.lower()
-    name = name.replace("×", "x").replace("/", " ").replace("(", " ").replace(")", " ").replace("&", " and ").replace("-", " ")
-    for word in remove_words:
-        name = re.sub(r"\b" + word + r"\b", " ", name)
+    # One C-level pass for all the punctuation rewrites instead of six replace() calls
+    name = name.lower().translate(punctuation_map)
+    name = regex_remove_words.sub(" ", name)
     name = regex_remove.sub(" ", name)
-    name = re.sub(r"\s+", " ", name)
-    return name.strip()
+    # split()/join collapses whitespace and trims the ends without the regex engine
+    name = " ".join(name.split())
+    # Intern so the same cleaned name from many feeds shares one string object
+    return sys.intern(name)
 
 # -----------------------------
 # FUZZY MATCHING (SAFE)
 # -----------------------------
-def similar(a, b):
-    return SequenceMatcher(None, a, b).ratio()
+FUZZY_THRESHOLD = 0.7
+
+def master_matchers(master_cleaned):
+    # SequenceMatcher caches its analysis of the second sequence, so keep one
+    # per master and only swap the channel name in
+    return [
+        (SequenceMatcher(None, "", master_clean), master_disp)
+        for master_clean, master_disp in master_cleaned.items()
+    ]
+
+def similar_enough(matcher, text):
+    # The quick ratios are upper bounds on ratio(); only run the full
+    # comparison when they cannot rule the pair out
+    matcher.set_seq1(text)
+    return (
+        matcher.real_quick_ratio() >= FUZZY_THRESHOLD
+        and matcher.quick_ratio() >= FUZZY_THRESHOLD
+        and matcher.ratio() >= FUZZY_THRESHOLD
+    )
 
 # -----------------------------
 # LOAD MASTER LIST
@@ -45,80 +95,237 @@ def load_master_list():
     master_cleaned = {}
     master_display = []
 
-    with open(MASTER_LIST_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#"):
-                master_cleaned[clean_text(line)] = line
-                master_display.append(line)
+    with open(MASTER_LIST_FILE, "rb") as f:
+        data = f.read().decode("utf-8")
+
+    for line in data.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            cleaned = clean_text(line)
+            if cleaned in master_cleaned and master_cleaned[cleaned] != line:
+                print(f"Master list collision: {line!r} vs {master_cleaned[cleaned]!r}")
+            master_cleaned[cleaned] = line
+            master_display.append(line)
 
     return master_cleaned, master_display
 
 # -----------------------------
 # SPLIT MASTER INTO LOCAL / NON-LOCAL
 # -----------------------------
+regex_local_dt = re.compile(r"^[WK][A-Z]{2,4}-DT$")
+
 def split_master(master_display):
     local = set()
     non_local = set()
 
     for ch in master_display:
-        if re.match(r"^[WK][A-Z]{2,4}-DT$", ch):
+        if regex_local_dt.match(ch):
             local.add(ch)
         else:
             non_local.add(ch)
-    return local, non_local
+    # Frozen: these are only ever used for membership tests, including in the parse workers
+    return frozenset(local), frozenset(non_local)
 
 # -----------------------------
 # LOAD EPG SOURCES
 # -----------------------------
 def load_epg_sources():
+    with open(EPG_SOURCES_FILE, "rb") as f:
+        data = f.read().decode("utf-8")
+
     sources = []
-    with open(EPG_SOURCES_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and line.startswith("http"):
-                sources.append(line)
+    for line in data.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#") and line.startswith("http"):
+            sources.append(line)
     return sources
 
 # -----------------------------
 # FETCH
 # -----------------------------
-def fetch_content(url):
+def create_session():
+    # One pooled session so sources sharing a host reuse the TCP/TLS connection
+    session = requests.Session()
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": "CustomEPG/1.0 (+https://github.com/ahmadmmasood/merged-epg)",
+    })
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def feed_cache_paths(url):
+    # Validators live in a small JSON sidecar so checking them never loads the payload
+    base = os.path.join(FEED_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest())
+    return base + ".json", base + ".payload"
+
+def load_feed_validators(meta_path, payload_path):
+    if not os.path.exists(payload_path):
+        return None, None
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        return meta.get("etag"), meta.get("last_modified")
+    except (OSError, ValueError, AttributeError):
+        return None, None
+
+def replace_file(path, data, mode="wb"):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def save_feed_cache(meta_path, payload_path, etag, last_modified, content):
     try:
-        r = requests.get(url, timeout=60)
+        os.makedirs(FEED_CACHE_DIR, exist_ok=True)
+        if not (etag or last_modified):
+            # Nothing to revalidate with; drop any stale validators
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            return
+        replace_file(payload_path, content)
+        replace_file(meta_path, json.dumps({"etag": etag, "last_modified": last_modified}), "w")
+    except OSError as e:
+        print(f"Could not cache {payload_path}: {e}")
+
+def fetch_content(session, url):
+    # Conditional GET: an unchanged feed answers 304 and the last payload is
+    # read back from disk; only then is the cached copy touched at all
+    meta_path, payload_path = feed_cache_paths(url)
+    etag, last_modified = load_feed_validators(meta_path, payload_path)
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    try:
+        r = session.get(url, timeout=FETCH_TIMEOUT, headers=headers)
+        if r.status_code == 304 and headers:
+            with open(payload_path, "rb") as f:
+                return f.read()
         r.raise_for_status()
+        save_feed_cache(
+            meta_path, payload_path,
+            r.headers.get("ETag"), r.headers.get("Last-Modified"), r.content,
+        )
         return r.content
     except Exception as e:
         print(f"Error fetching {url}: {e}")
         return None
 
+def prefetch_sources(session, urls, ahead=FETCH_AHEAD):
+    # Keep up to `ahead` downloads in flight; yields (url, content) in source
+    # order and only starts a new download as the caller takes one, so memory
+    # stays bounded as long as the caller does not hoard the payloads
+    url_iter = iter(urls)
+    with ThreadPoolExecutor(max_workers=ahead) as pool:
+        pending = deque(
+            (url, pool.submit(fetch_content, session, url))
+            for url in islice(url_iter, ahead)
+        )
+        while pending:
+            url, future = pending.popleft()
+            for next_url in islice(url_iter, 1):
+                pending.append((next_url, pool.submit(fetch_content, session, next_url)))
+            yield url, future.result()
+
 # -----------------------------
 # PARSE XML STREAM
 # -----------------------------
+def release_element(elem):
+    # Clear the element and drop the siblings already handled before it, so the
+    # partially built tree never grows past the element being processed
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+def first_subset_match(tokens, token_index, master_sizes):
+    # Earliest master whose tokens are all in `tokens`: count the hits each
+    # master gets from the inverted index and compare with its token count
+    hits = {}
+    best = None
+    for token in tokens:
+        for pos in token_index.get(token, ()):
+            count = hits.get(pos, 0) + 1
+            hits[pos] = count
+            if count == master_sizes[pos] and (best is None or pos < best):
+                best = pos
+    return best
+
+def picklable_errors(context):
+    # lxml's XMLSyntaxError carries its error log, which cannot be pickled back
+    # from a worker process; re-raise it as a plain ValueError
+    try:
+        yield from context
+    except ET.XMLSyntaxError as e:
+        raise ValueError(f"XML error: {e}") from None
+
 def parse_xml_stream(content_bytes, master_cleaned, local_channels, days_limit=7):
     channel_matches = {}   # raw_id -> master_display_name
     programmes = []
 
-    cutoff = datetime.utcnow() + timedelta(days=days_limit)
-
-    try:
-        f = gzip.open(BytesIO(content_bytes), "rb")
-        f.peek(1)
-    except:
+    cutoff = datetime.now(timezone.utc) + timedelta(days=days_limit)
+    # XMLTV timestamps are zero-padded, so UTC starts compare correctly as strings
+    cutoff_str = cutoff.strftime("%Y%m%d%H%M%S")
+
+    # Master names are already normalized; index their tokens once per feed so
+    # subset matching only visits masters sharing a token with the channel
+    master_sizes = []
+    master_names = []
+    token_index = {}   # token -> master positions, in master order
+    empty_master = None
+    for pos, (master_clean, master_disp) in enumerate(master_cleaned.items()):
+        tokens = frozenset(master_clean.split())
+        master_sizes.append(len(tokens))
+        master_names.append(master_disp)
+        if not tokens and empty_master is None:
+            empty_master = pos
+        for token in tokens:
+            token_index.setdefault(token, []).append(pos)
+    fuzzy_masters = None   # built the first time a channel reaches the fuzzy step
+    pacific_masters = frozenset(disp for disp in master_cleaned.values() if "pacific" in disp.lower())
+
+    # Decide on the gzip magic bytes instead of test-decompressing and catching the failure
+    if content_bytes[:2] == GZIP_MAGIC:
+        # Hand libxml2 large decompressed reads instead of the small ones it asks for
+        f = BufferedReader(feed_gzip.GzipFile(fileobj=BytesIO(content_bytes)), READ_BUFFER_SIZE)
+    else:
         f = BytesIO(content_bytes)
 
-    context = ET.iterparse(f, events=("end",))
+    # Let libxml2 filter on tag so only <channel>/<programme> elements reach Python
+    context = ET.iterparse(
+        f,
+        events=("end",),
+        tag=("channel", "programme"),
+        remove_blank_text=True,
+    )
+
+    # Bind hot-loop lookups to locals once per feed
+    keep = programmes.append
+    tostring = ET.tostring
 
-    for event, elem in context:
+    for event, elem in picklable_errors(context):
 
         # ------------------ CHANNEL ------------------
         if elem.tag == "channel":
-            raw_id = elem.attrib.get("id", "")
+            raw_id = elem.get("id", "")
+
+            # Feeds often repeat a channel; only the first match is ever written
+            if raw_id in channel_matches:
+                release_element(elem)
+                continue
+
             display = elem.findtext("display-name") or raw_id
 
             # Skip channels containing "pacific"
             if "pacific" in display.lower():
-                elem.clear()
+                release_element(elem)
                 continue
 
             # Deduplicate repeated <icon> in channel
@@ -130,8 +337,8 @@ def parse_xml_stream(content_bytes, master_cleaned, local_channels, days_limit=7
             # Local DT channels: exact match
             if display in local_channels:
                 channel_matches[raw_id] = display
-                programmes.append((raw_id, ET.tostring(elem, encoding="utf-8")))
-                elem.clear()
+                keep((raw_id, tostring(elem, encoding="utf-8")))
+                release_element(elem)
                 continue
 
             # Non-local channels: previous matching logic
@@ -143,23 +350,29 @@ def parse_xml_stream(content_bytes, master_cleaned, local_channels, days_limit=7
                 matched_display = master_cleaned[cleaned_display]
 
             if not matched_display:
-                for master_clean, master_disp in master_cleaned.items():
-                    master_tokens = set(master_clean.split())
-                    display_tokens = set(cleaned_display.split())
-                    id_tokens = set(cleaned_id.split())
-                    if master_tokens.issubset(display_tokens) or master_tokens.issubset(id_tokens):
-                        matched_display = master_disp
-                        break
+                # An empty master token set is a subset of anything, as before
+                candidates = [
+                    pos for pos in (
+                        empty_master,
+                        first_subset_match(set(cleaned_display.split()), token_index, master_sizes),
+                        first_subset_match(set(cleaned_id.split()), token_index, master_sizes),
+                    )
+                    if pos is not None
+                ]
+                if candidates:
+                    matched_display = master_names[min(candidates)]
 
             if not matched_display:
-                for master_clean, master_disp in master_cleaned.items():
-                    if similar(cleaned_display, master_clean) >= 0.7 or similar(cleaned_id, master_clean) >= 0.7:
+                if fuzzy_masters is None:
+                    fuzzy_masters = master_matchers(master_cleaned)
+                for matcher, master_disp in fuzzy_masters:
+                    if similar_enough(matcher, cleaned_display) or similar_enough(matcher, cleaned_id):
                         matched_display = master_disp
                         break
 
             if matched_display:
-                if "pacific" in matched_display.lower():
-                    elem.clear()
+                if matched_display in pacific_masters:
+                    release_element(elem)
                     continue
                 channel_matches[raw_id] = matched_display
 
@@ -175,90 +388,162 @@ def parse_xml_stream(content_bytes, master_cleaned, local_channels, days_limit=7
                         if not (t.text and t.text.strip()):
                             elem.remove(t)
 
-                programmes.append((raw_id, ET.tostring(elem, encoding="utf-8")))
+                keep((raw_id, tostring(elem, encoding="utf-8")))
 
-            elem.clear()
+            release_element(elem)
 
         # ------------------ PROGRAMME ------------------
         elif elem.tag == "programme":
-            raw_channel = elem.attrib.get("channel")
-            start_str = elem.attrib.get("start")
+            raw_channel = elem.get("channel")
 
             if raw_channel not in channel_matches:
-                elem.clear()
+                release_element(elem)
                 continue
 
-            try:
-                start_dt = datetime.strptime(start_str.strip(), "%Y%m%d%H%M%S %z")
-                start_dt = start_dt.astimezone(pytz.utc).replace(tzinfo=None)
-            except:
-                elem.clear()
-                continue
+            start_str = (elem.get("start") or "").strip()
+
+            # Fast path: "YYYYMMDDHHMMSS +0000" needs no datetime parsing at all
+            if len(start_str) == 20 and start_str.endswith(" +0000") and start_str[:14].isdigit():
+                in_window = start_str[:14] <= cutoff_str
+            else:
+                try:
+                    in_window = datetime.strptime(start_str, "%Y%m%d%H%M%S %z") <= cutoff
+                except ValueError:
+                    release_element(elem)
+                    continue
+
+            if in_window:
+                # Deduplicate <icon> in programme element
+                icons_prog = elem.findall("icon")
+                for i, icon in enumerate(icons_prog):
+                    if i > 0:
+                        elem.remove(icon)
+                # Remove empty optional tags
+                for empty_tag in ["premiere", "previously-shown"]:
+                    for t in elem.findall(empty_tag):
+                        if not (t.text and t.text.strip()):
+                            elem.remove(t)
 
-            if start_dt <= cutoff:
-                key = (raw_channel, start_str, ET.tostring(elem, encoding="utf-8"))
-                if key not in parse_xml_stream.seen_programmes:
-                    # Deduplicate <icon> in programme element
-                    icons_prog = elem.findall("icon")
-                    for i, icon in enumerate(icons_prog):
-                        if i > 0:
-                            elem.remove(icon)
-                    # Remove empty optional tags
-                    for empty_tag in ["premiere", "previously-shown"]:
-                        for t in elem.findall(empty_tag):
-                            if not (t.text and t.text.strip()):
-                                elem.remove(t)
-
-                    programmes.append((raw_channel, ET.tostring(elem, encoding="utf-8")))
-                    parse_xml_stream.seen_programmes.add(key)
-
-            elem.clear()
+                keep((raw_channel, tostring(elem, encoding="utf-8")))
+
+            release_element(elem)
 
     return channel_matches, programmes
 
-parse_xml_stream.seen_programmes = set()
+# Master data is handed to each parse worker once at start-up rather than
+# being pickled along with every feed
+worker_master_cleaned = None
+worker_local_channels = None
+
+def init_parse_worker(master_cleaned, local_channels):
+    global worker_master_cleaned, worker_local_channels
+    worker_master_cleaned = master_cleaned
+    worker_local_channels = local_channels
+
+def parse_feed(content_bytes):
+    return parse_xml_stream(content_bytes, worker_master_cleaned, worker_local_channels)
+
+def parse_in_order(pool, prefetched, max_pending):
+    # Yields (url, job) in source order with at most `max_pending` payloads
+    # queued in the pool; pulling the next download waits on the oldest parse,
+    # so compressed feeds cannot pile up in memory behind slow workers
+    pending = deque()
+    for url, content in prefetched:
+        if content:
+            pending.append((url, pool.submit(parse_feed, content)))
+        if len(pending) >= max_pending:
+            yield pending.popleft()
+    yield from pending
 
 # -----------------------------
-# SAVE MERGED XML
+# CROSS-FEED PROGRAMME DEDUPE
 # -----------------------------
-def save_merged_xml(channel_id_map, programmes):
-    with gzip.open(OUTPUT_XML_GZ, "wb") as f_out:
-        f_out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
-        f_out.write(b"<tv generator-info-name=\"CustomEPG\">\n")
-
-        written_channels = set()
-        for raw_id, prog_xml in programmes:
-            if prog_xml.startswith(b"<channel") and raw_id not in written_channels:
-                f_out.write(prog_xml)
-                written_channels.add(raw_id)
-
-        for raw_id, prog_xml in programmes:
-            if not prog_xml.startswith(b"<channel"):
-                f_out.write(prog_xml)
+def drop_seen_programmes(programmes, seen_programmes):
+    # Parsing runs in worker processes, so the dedupe across feeds happens here
+    # on the main process, in source order
+    kept = []
+    for raw_id, xml in programmes:
+        if xml.startswith(b"<programme"):
+            key = (raw_id, xml)
+            if key in seen_programmes:
+                continue
+            seen_programmes.add(key)
+        kept.append((raw_id, xml))
+    return kept
 
-        f_out.write(b"\n</tv>")
+# -----------------------------
+# PROGRAMME COUNT
+# -----------------------------
+def count_programmes(programmes):
+    # Kept entries are already-serialized bytes, so a prefix test is enough to
+    # tell <programme> from <channel> without touching the XML again
+    return sum(1 for _, xml in programmes if xml.startswith(b"<programme"))
 
 # -----------------------------
-# INDEX REPORT
+# SAVE MERGED XML
 # -----------------------------
-def update_index(master_display, matched_display_names):
-    found = []
-    not_found = []
+def unique_channels(programmes):
+    written_channels = set()
+    for raw_id, prog_xml in programmes:
+        if prog_xml.startswith(b"<channel") and raw_id not in written_channels:
+            written_channels.add(raw_id)
+            yield prog_xml
+
+def merged_xml_chunks(programmes):
+    yield b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield b"<tv generator-info-name=\"CustomEPG\">\n"
+    yield from unique_channels(programmes)
+    yield from (prog_xml for _, prog_xml in programmes if not prog_xml.startswith(b"<channel"))
+    yield b"\n</tv>"
 
-    size_mb = os.path.getsize(OUTPUT_XML_GZ) / (1024 * 1024)
-    timestamp = datetime.now(pytz.timezone("US/Eastern")).strftime("%Y-%m-%d %H:%M:%S %Z")
+def save_merged_xml(channel_id_map, programmes):
+    # Always stdlib zlib, even when isal is installed: this file is published and
+    # downloaded by every client, and isal's levels come out 15-25% larger.
+    # Level 6 is within ~2% of level 9 for far less CPU. A 1 MiB buffer batches
+    # the many small fragment writes
+    with gzip.open(OUTPUT_XML_GZ, "wb", compresslevel=OUTPUT_COMPRESSLEVEL) as gz_out, \
+            BufferedWriter(gz_out, buffer_size=WRITE_BUFFER_SIZE) as f_out:
+        # Hand the fragments to writelines() rather than calling write() per element
+        f_out.writelines(merged_xml_chunks(programmes))
 
-    for channel in master_display:
-        if channel in matched_display_names:
-            found.append(channel)
-        else:
-            not_found.append(channel)
+# -----------------------------
+# UNCHANGED OUTPUT CHECK
+# -----------------------------
+def output_digest(programmes, master_display, matched_display_names):
+    # Covers everything merged.xml.gz and index.html are built from except the
+    # timestamp, so an identical digest means both would come out the same.
+    # The rendering settings are folded in so a format change forces a rewrite
+    digest = hashlib.sha256()
+    digest.update(repr((
+        OUTPUT_FORMAT_VERSION,
+        OUTPUT_COMPRESSLEVEL,
+        INDEX_HEADER,
+        INDEX_MIDDLE,
+        INDEX_ROW,
+        INDEX_FOOTER,
+    )).encode("utf-8"))
+    for chunk in merged_xml_chunks(programmes):
+        digest.update(chunk)
+    for names in (master_display, matched_display_names):
+        digest.update("\n".join(sorted(names)).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def read_output_digest():
+    try:
+        with open(OUTPUT_HASH_FILE, encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return None
 
-    def make_table(ch_list):
-        rows = "".join(f"<tr><td>{c}</td></tr>" for c in sorted(ch_list))
-        return f"<details><summary>Click to expand ({len(ch_list)})</summary><table>{rows}</table></details>"
+def write_output_digest(digest):
+    with open(OUTPUT_HASH_FILE, "w", encoding="ascii") as f:
+        f.write(digest + "\n")
 
-    html = f"""
+# -----------------------------
+# INDEX REPORT
+# -----------------------------
+INDEX_HEADER = """
 <html>
 <head>
 <title>EPG Merge Report</title>
@@ -271,19 +556,52 @@ details {{margin-bottom: 10px;}}
 <body>
 <h2>EPG Merge Report</h2>
 <p>Generated: {timestamp}</p>
-<p>Total channels in master list: {len(master_display)}</p>
-<p>Channels found: {len(found)}</p>
-<p>Channels not found: {len(not_found)}</p>
+<p>Total channels in master list: {total}</p>
+<p>Channels found: {found}</p>
+<p>Channels not found: {not_found}</p>
 <p>Final merged XML.GZ size: {size_mb:.2f} MB</p>
 
-<h3>Found Channels</h3>{make_table(found)}
-<h3>Not Found Channels</h3>{make_table(not_found)}
+<h3>Found Channels</h3><details><summary>Click to expand ({found})</summary><table>"""
+
+INDEX_MIDDLE = """</table></details>
+<h3>Not Found Channels</h3><details><summary>Click to expand ({not_found})</summary><table>"""
+
+INDEX_ROW = "<tr><td>%s</td></tr>"
+
+INDEX_FOOTER = """</table></details>
 
 </body>
 </html>
 """
+
+def file_size_mb(path):
+    # One stat() per fact: a missing file simply reports 0
+    try:
+        return os.stat(path).st_size / (1024 * 1024)
+    except OSError:
+        return 0.0
+
+def update_index(master_display, matched_display_names, size_mb):
+    timestamp = datetime.now(EASTERN_TZ).strftime("%Y-%m-%d %H:%M:%S %Z")
+
+    # Set algebra does the membership work in C; sort each side once and stream
+    # rows straight to disk instead of building the page in memory
+    master_set = frozenset(master_display)
+    found = sorted(master_set & matched_display_names)
+    not_found = sorted(master_set - matched_display_names)
+
     with open(INDEX_HTML, "w", encoding="utf-8") as f:
-        f.write(html)
+        f.write(INDEX_HEADER.format(
+            timestamp=timestamp,
+            total=len(master_set),
+            found=len(found),
+            not_found=len(not_found),
+            size_mb=size_mb,
+        ))
+        f.writelines(INDEX_ROW % escape(c) for c in found)
+        f.write(INDEX_MIDDLE.format(not_found=len(not_found)))
+        f.writelines(INDEX_ROW % escape(c) for c in not_found)
+        f.write(INDEX_FOOTER)
 
 # -----------------------------
 # MAIN
@@ -297,44 +615,64 @@ def main():
     all_programmes = []
     matched_display_names = set()
 
-    print(f"Master channels loaded: {len(master_display)}")
+    print(f"Master channels loaded: {len(set(master_display))}")
     print(f"EPG sources loaded: {len(sources)}")
 
-    for url in sources:
-        print(f"\nProcessing: {url}")
-
-        content = fetch_content(url)
-        if not content:
-            continue
-
-        is_local_feed = (url == LOCAL_FEED_URL)
-
-        channel_map, programmes = parse_xml_stream(
-            content,
-            master_cleaned,
-            local_channels
-        )
-
-        if is_local_feed:
-            channel_map = {raw: disp for raw, disp in channel_map.items() if disp in local_channels}
-        else:
-            channel_map = {raw: disp for raw, disp in channel_map.items() if disp in non_local_channels}
-
-        all_channel_map.update(channel_map)
-        all_programmes.extend(programmes)
-        matched_display_names.update(channel_map.values())
-
-        print(f"  Channels matched: {len(channel_map)}")
-        print(f"  Programmes kept: {len(programmes)}")
-
-    save_merged_xml(all_channel_map, all_programmes)
-    update_index(master_display, matched_display_names)
-
-    size_mb = os.path.getsize(OUTPUT_XML_GZ) / (1024 * 1024)
+    session = create_session()
+    seen_programmes = set()
+
+    # Feeds are parsed in parallel worker processes as their downloads arrive;
+    # results are merged back here in source order
+    workers = max(1, min(len(sources), os.cpu_count() or 1))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_parse_worker,
+        initargs=(master_cleaned, local_channels),
+    ) as pool:
+        for url, job in parse_in_order(pool, prefetch_sources(session, sources), workers):
+            print(f"\nProcessing: {url}")
+
+            is_local_feed = (url == LOCAL_FEED_URL)
+
+            # A truncated or malformed feed raises (EOFError from gzip, XMLSyntaxError
+            # from lxml); skip that feed rather than publish half-parsed elements
+            try:
+                channel_map, programmes = job.result()
+            except Exception as e:
+                print(f"Error parsing {url}: {e}")
+                continue
+            programmes = drop_seen_programmes(programmes, seen_programmes)
+
+            if is_local_feed:
+                channel_map = {raw: disp for raw, disp in channel_map.items() if disp in local_channels}
+            else:
+                channel_map = {raw: disp for raw, disp in channel_map.items() if disp in non_local_channels}
+
+            all_channel_map.update(channel_map)
+            all_programmes.extend(programmes)
+            matched_display_names.update(channel_map.values())
+
+            print(f"  Channels matched: {len(channel_map)}")
+            print(f"  Programmes kept: {count_programmes(programmes)}")
+
+    # Scheduled runs often see identical feeds; skip recompressing and
+    # rewriting the outputs when nothing in them would change
+    digest = output_digest(all_programmes, master_display, matched_display_names)
+    if (digest == read_output_digest()
+            and os.path.exists(OUTPUT_XML_GZ)
+            and os.path.exists(INDEX_HTML)):
+        print("\nMerged EPG unchanged; keeping existing output.")
+        size_mb = file_size_mb(OUTPUT_XML_GZ)
+    else:
+        save_merged_xml(all_channel_map, all_programmes)
+        size_mb = file_size_mb(OUTPUT_XML_GZ)
+        update_index(master_display, matched_display_names, size_mb)
+        write_output_digest(digest)
 
     print("\nFinished.")
     print(f"Final channels: {len(set(all_channel_map.values()))}")
-    print(f"Final programmes: {len(all_programmes)}")
+    print(f"Final programmes: {count_programmes(all_programmes)}")
     print(f"Output size: {size_mb:.2f} MB")
 
 